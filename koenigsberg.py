@@ -128,6 +128,7 @@ def parse_args(args) -> None:
     parser.add_argument('--min-save-interval', '--min-save', '-n', type=int, help="Minimum amount of time, in seconds, between checkpointing saves. Increasing this makes the program slightly faster but means you'll lose more progress if it's interrupted.")
     parser.add_argument('--abandoned-report-length-interval', '--abandoned-length', '-a', type=int, help=f"Length of paths that cause a status message to be emitted when the path is abandoned at verbosity level {util.VERBOSITY_REPORT_SELECTED_ABANDONED_PATHS}.")
     parser.add_argument('--abandoned-report-number-interval', '--abandoned-number', '-r', type=int, help=f"Length of paths that cause a status message to be emitted when the path is abandoned at verbosity level {util.VERBOSITY_REPORT_SELECTED_ABANDONED_PATHS}.")
+    parser.add_argument('--jobs', '-j', type=int, help="Number of worker processes to spread the search across. Has no effect when --checkpoint-file is used.")
     parser.add_argument('--prune-exhausted-interval', '-p', type=int, help="Threshold for cleaning up the list of paths we've exhausted; doing this more often will make the program run faster when it's not cleaning this list but will make the list-cleaning action happen more often.")
 
     parser.add_argument('--verbose', '-v', action='count', default=1, help="Increase how chatty the program is about the progress it makes. May be specified multiple times.")
@@ -155,15 +156,17 @@ def parse_args(args) -> None:
         kl.abandoned_paths_number_report_interval = args.abandoned_report_number_interval
     if args.prune_exhausted_interval:
         kl.exhausted_paths_prune_threshold = args.prune_exhausted_interval
+    if args.jobs:
+        kl.num_jobs = args.jobs
 
     assert not (args.graph and args.map), "ERROR! Only one of --graph or --map may be specified."
     assert args.graph or args.map, "ERROR! One of --graph or --map must be specified."
     if args.graph:
         graph = read_graph_file(args.graph)
-        kl.print_all_graph_solutions(graph)
+        kl.print_all_graph_solutions(graph, sanity_checked=True)          # read_graph_file() already checked it
     elif args.map:
         map = read_map_file(args.map)
-        kl.print_single_dict_solutions(map)
+        kl.print_single_dict_solutions(map, sanity_checked=True)          # read_map_file() already checked it
     else:
         print("You must specify either --map or --graph!")
         sys.exit(2)
@@ -31,12 +31,22 @@ version. See the file LICENSE.md for details.
 """
 
 
+import base64
 import bz2
+import concurrent.futures
+import gzip
+import json
+import os
 import pickle
+import shutil
 import time
 
 from pathlib import Path
-from typing import Callable, Dict, Generator, Hashable, Iterable, Tuple
+from typing import Callable, Dict, Generator, Hashable, Iterable, List, Tuple
+
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from libc.stdint cimport uint64_t
+from libc.string cimport memcpy, memset
 
 import util
 
@@ -44,17 +54,34 @@ import util
 # Constants
 __version__ = "alpha"
 
+cdef enum:
+    MAX_IDS = 256                   # Path and node IDs run from 1 to 255; zero means "no path" in STEPS_TAKEN
+    VISITED_WORDS = 4               # 64-bit words needed for a bitmask with one bit per possible path ID
+
+
+# C-level representation of the graph being solved, built by _build_graph_tables() from normalized dicts. The
+# paths leaving each node are stored as a bitmask laid out like the solver's mask of paths already used, so the
+# paths still available from node N are PATH_MASKS[N] & ~VISITED. The two ends of each path are XORed together in
+# OTHER_END, so crossing path P from node N leads to node N ^ OTHER_END[P].
+cdef struct graph_tables:
+    int num_paths
+    int num_words                                   # words of each mask that can have any bits set
+    uint64_t path_masks[MAX_IDS][VISITED_WORDS]     # bit P of PATH_MASKS[N] is set if path P leads out of node N
+    unsigned char other_end[MAX_IDS]                # the IDs of the two nodes connected by each path, XORed
+
 # File system locations
 script_home = Path(__file__).parent.resolve()
 sample_data = script_home / 'sample_data'
 
 # Global variables tracking the list of paths that have been explored exhaustively.
 exhausted_paths = None              # or a set(), if we're tracking progress
+unsaved_exhausted_paths = list()    # exhausted paths found since progress was last saved
 cdef long paths_length_at_last_prune = 0
 cdef long total_paths_exhausted_num = 0
 
 # Global variables tracking solutions found.
 cdef set solutions = set()
+on_solution = None                  # or a callable, which is passed each solution, as bytes, instead of printing it
 
 # Global variables that can be set with command_line parameters follow
 
@@ -63,6 +90,10 @@ checkpoint_interval = 10              # save occurs when length of path being ab
 min_save_interval = 15 * 60           # seconds
 last_save = time.monotonic()
 checkpoint_path = None                          # or a Path
+journal_compaction_interval = 20      # incremental saves between full rewrites of the checkpoint file
+saves_since_full_save = journal_compaction_interval    # starts "due", so the first save of a run is a full one
+journaled_solutions = set()           # solutions already written to the checkpoint file or its journal
+checkpoint_compression_level = 4      # gzip level for the checkpoint file; higher is smaller but slower to save
 
 # Having to do with how often abandoned paths are reported at the level VERBOSITY_REPORT_SELECTED_ABANDONED_PATHS
 abandoned_paths_length_report_interval = 8
@@ -71,17 +102,29 @@ abandoned_paths_number_report_interval = 100000
 # Having to do with how often the list of exhausted paths is pruned.
 exhausted_paths_prune_threshold = 1000      #FIXME! Experiment with this value
 
+# Having to do with remembering positions in the search from which no solution can be completed.
+dead_end_cache_limit = 1000000              # the cache is emptied when it grows past this many entries
+dead_end_min_remaining = 12                  # only remember states with at least this many paths still to cross
+
+# Having to do with running in parallel
+num_jobs = 1                        # worker processes to spread starting points across; 1 means solve in this process
+
 # The function used to convert a bytearray into a printed output path
-output_func = lambda the_bytes, *args: ''.join(chr(o) for o in the_bytes)
+def _default_output_func(the_bytes: bytearray, *args) -> str:
+    return ''.join(chr(o) for o in the_bytes)
+
+output_func = _default_output_func
 
 # Other globals
 run_start = time.monotonic()
+indents = tuple(' ' * i for i in range(MAX_IDS))     # indentation for reports of abandoned paths, by path length
 
 
 cpdef void reset_data(bint confirm=False):
     """Reset the variables used to track progress to their initial values.
     """
     global exhausted_paths, solutions, paths_length_at_last_prune, total_paths_exhausted_num, run_start
+    global unsaved_exhausted_paths, journaled_solutions, saves_since_full_save
     if not confirm: 
         print("ERROR! reset_data() called without confirm=True. To avoid accidentally scuttling progres data, reset_data() must be called while manually passing confirm=True.")
         return
@@ -91,6 +134,9 @@ cpdef void reset_data(bint confirm=False):
     paths_length_at_last_prune = 0
     total_paths_exhausted_num = 0
     run_start = time.monotonic()
+    unsaved_exhausted_paths = list()
+    journaled_solutions = set()
+    saves_since_full_save = journal_compaction_interval
 
 
 cdef void do_prune_exhausted_paths_list() except *:
@@ -106,102 +152,418 @@ cdef void do_prune_exhausted_paths_list() except *:
     paths can be added to the list before the list is pruned.
     """
     cdef bytes p
+    cdef bytes last_kept = None
     cdef set pruned_paths_list
-    cdef long length
 
     global exhausted_paths, paths_length_at_last_prune
 
     if not exhausted_paths:
         return
 
+    # In sorted order, every path that starts with another path comes after it, and so do any paths between them,
+    # which also start with it. So each path only needs to be compared to the last path kept.
     pruned_paths_list = set()
-    for p in sorted(exhausted_paths, key=len):
-        for length in range(1+len(p)):
-            if bytes(p[:length]) in pruned_paths_list:
-                break
-        else:
+    for p in sorted(exhausted_paths):
+        if (last_kept is None) or (not p.startswith(last_kept)):
             pruned_paths_list.add(p)
+            last_kept = p
 
     exhausted_paths = pruned_paths_list
     paths_length_at_last_prune = len(pruned_paths_list)
 
 
-def do_save(even_if_not_time: bool = False,
-            suppress_prune: bool = False) -> None:
-    """Save our current status, so we can restart from this point later.
+def _journal_path() -> Path:
+    """Return the location of the journal file that accompanies the checkpoint file
+    at CHECKPOINT_PATH.
     """
-    global solutions, exhausted_paths, total_paths_exhausted_num, run_start, last_save
+    return checkpoint_path.with_suffix(checkpoint_path.suffix + '.journal')
+
+
+def _backup_path() -> Path:
+    """Return the location of the backup copy of the previous checkpoint file, kept
+    alongside the checkpoint file at CHECKPOINT_PATH.
+    """
+    return checkpoint_path.with_suffix(checkpoint_path.suffix + '.bak')
+
+
+def _pack_paths(paths: Iterable[bytes]) -> bytes:
+    """Pack PATHS into a single bytes object for the checkpoint file: each path, in
+    sorted order, preceded by a byte giving its length. Sorting puts paths that share
+    a beginning next to each other, so the result compresses much better, and much
+    faster, than a pickled set of the same paths.
+    """
+    return b''.join(bytes((len(p),)) + p for p in sorted(paths))
+
+
+def _unpack_paths(packed: bytes) -> set:
+    """Turn a bytes object produced by _pack_paths() back into a set of paths.
+    """
+    ret, pos = set(), 0
+    while pos < len(packed):
+        length = packed[pos]
+        ret.add(packed[pos + 1 : pos + 1 + length])
+        pos += 1 + length
+    return ret
+
+
+def _do_full_save(suppress_prune: bool = False) -> None:
+    """Write everything we know about our progress to the checkpoint file, then
+    discard the journal, whose contents are now included in the checkpoint file.
+
+    The new data is written to a temporary file and only moved into place, in a
+    single atomic rename, once it's safely on disk, so being interrupted in the
+    middle of a save leaves either the previous checkpoint file or the new one at
+    CHECKPOINT_PATH, never a damaged one or none at all. A copy of the previous
+    checkpoint file is kept as a backup; the live file is never moved out of the way
+    to make it.
+    """
+    global unsaved_exhausted_paths, journaled_solutions, saves_since_full_save
 
-    if not checkpoint_path:         # no checkpoint file defined? We're not saving!
-        return
-    if (not even_if_not_time) and ((time.monotonic() - last_save) < min_save_interval):
-        return
     if not suppress_prune:
         do_prune_exhausted_paths_list()
 
     data = {
-        'solutions': solutions,
-        'exhausted_paths': exhausted_paths,
+        'solutions': _pack_paths(solutions),
+        'exhausted_paths': _pack_paths(exhausted_paths),
         'num_exhausted': total_paths_exhausted_num,
         'total_time': time.monotonic() - run_start,
     }
 
+    temp_path = checkpoint_path.with_suffix(checkpoint_path.suffix + '.tmp')
+    with open(temp_path, mode='wb') as raw_file:
+        with gzip.GzipFile(fileobj=raw_file, mode='wb', compresslevel=checkpoint_compression_level) as checkpoint_file:
+            pickle.dump(data, checkpoint_file, protocol=-1)
+        raw_file.flush()
+        os.fsync(raw_file.fileno())
+
     if checkpoint_path.exists():
-        checkpoint_path.rename(checkpoint_path.with_suffix(checkpoint_path.resolve().suffix + '.bak'))
-    with bz2.open(checkpoint_path, mode='wb') as checkpoint_file:
-        pickle.dump(data, checkpoint_file, protocol=-1)
+        shutil.copy2(checkpoint_path, _backup_path())
+    os.replace(temp_path, checkpoint_path)
+    _journal_path().unlink(missing_ok=True)
+
+    unsaved_exhausted_paths = list()
+    journaled_solutions = set(solutions)
+    saves_since_full_save = 0
 
-    util.log_it(f"Progress saved to {checkpoint_path.name}! {len(solutions)} solutions found and {total_paths_exhausted_num} paths exhaused in {data['total_time'] / 60:.10} minutes.",
+
+def _do_journal_save() -> None:
+    """Append the progress made since the last save to the journal as a single line
+    of JSON, rather than rewriting the whole checkpoint file.
+    """
+    global unsaved_exhausted_paths, journaled_solutions, saves_since_full_save
+
+    new_solutions = solutions - journaled_solutions
+    entry = {
+        'exhausted_paths': [base64.b64encode(p).decode('ascii') for p in unsaved_exhausted_paths],
+        'solutions': [base64.b64encode(s).decode('ascii') for s in new_solutions],
+        'num_exhausted': total_paths_exhausted_num,
+        'total_time': time.monotonic() - run_start,
+    }
+    with gzip.open(_journal_path(), mode='at', encoding='ascii') as journal_file:
+        journal_file.write(json.dumps(entry) + '\n')
+
+    unsaved_exhausted_paths = list()
+    journaled_solutions |= new_solutions
+    saves_since_full_save += 1
+
+
+def do_save(even_if_not_time: bool = False,
+            suppress_prune: bool = False) -> None:
+    """Save our current status, so we can restart from this point later.
+
+    Most saves just append the progress made since the previous save to a journal
+    kept alongside the checkpoint file. The checkpoint file itself is rewritten,
+    and the journal discarded, on the first save of each run (including runs that
+    resume from an existing checkpoint), on every
+    JOURNAL_COMPACTION_INTERVALth save after that, and whenever EVEN_IF_NOT_TIME is
+    True.
+    """
+    global last_save
+
+    if not checkpoint_path:         # no checkpoint file defined? We're not saving!
+        return
+    if (not even_if_not_time) and ((time.monotonic() - last_save) < min_save_interval):
+        return
+
+    if even_if_not_time or (not checkpoint_path.exists()) or (saves_since_full_save >= journal_compaction_interval):
+        _do_full_save(suppress_prune)
+    else:
+        _do_journal_save()
+
+    util.log_it(f"Progress saved to {checkpoint_path.name}! {len(solutions)} solutions found and {total_paths_exhausted_num} paths exhaused in {(time.monotonic() - run_start) / 60:.10} minutes.",
                 util.VERBOSITY_REPORT_PROGRESS_ON_SAVE)
     last_save = time.monotonic()
 
 
-def do_load_progress() -> None:
-    """Restore progress from the file at the global CHECKPOINT_PATH variable, if it
-    exists; if it doesn't, report that it doesn't, and that we're restarting from
-    scratch.
+def _replay_journal() -> None:
+    """Apply the progress recorded in the journal accompanying the checkpoint file,
+    if there is one, on top of the progress loaded from the checkpoint file itself.
+    If the program was interrupted while writing to the journal, the last entry may
+    be damaged; everything before it is still used.
+
+    If the program was interrupted after a full save had written the checkpoint file
+    but before it could delete the journal, the journal's contents are already in
+    the checkpoint file. Replaying them again does no harm to the sets of paths, and
+    the counts of exhausted paths and time spent only ever move forward, so the
+    journal's older figures can't overwrite the checkpoint's newer ones.
     """
-    global solutions, exhausted_paths, total_paths_exhausted_num, run_start
+    global solutions, exhausted_paths, total_paths_exhausted_num, run_start, journaled_solutions
+    cdef int num_replayed = 0
 
-    util.log_it(f"  ... opening progress file {checkpoint_path.name} ...", util.VERBOSITY_REPORT_PROGRESS_ON_SAVE)
+    if not _journal_path().exists():
+        return
+
+    if exhausted_paths is None:
+        exhausted_paths = set()
     try:
-        with bz2.open(checkpoint_path, mode='rb') as checkpoint_file:
-            data = pickle.load(checkpoint_file)
-        solutions = data['solutions']
-        exhausted_paths = data['exhausted_paths']
-        total_paths_exhausted_num = data['num_exhausted']
-        run_start = time.monotonic() - data['total_time']
-        print(f"  ... data loaded from {checkpoint_path.name}!")
-    except (IOError, pickle.PickleError) as errrr:
-        print(f"Warning! Cannot load progress data from {checkpoint_path.name}; the system said: {errrr}")
+        with gzip.open(_journal_path(), mode='rt', encoding='ascii') as journal_file:
+            for line in journal_file:
+                entry = json.loads(line)
+                exhausted_paths.update(base64.b64decode(p) for p in entry['exhausted_paths'])
+                solutions.update(base64.b64decode(s) for s in entry['solutions'])
+                total_paths_exhausted_num = max(total_paths_exhausted_num, entry['num_exhausted'])
+                run_start = min(run_start, time.monotonic() - entry['total_time'])
+                num_replayed += 1
+    except (EOFError, IOError, ValueError, KeyError) as errrr:
+        print(f"Warning! The progress journal {_journal_path().name} is damaged; the system said: {errrr}")
+        print("Using the progress recorded before the damaged section.")
+
+    do_prune_exhausted_paths_list()
+    journaled_solutions = set(solutions)
+    util.log_it(f"  ... {num_replayed} incremental saves replayed from {_journal_path().name}!", util.VERBOSITY_REPORT_PROGRESS_ON_SAVE)
+
+
+def do_load_progress() -> None:
+    """Restore progress from the file at the global CHECKPOINT_PATH variable, if it
+    exists. If it's missing or can't be read, fall back on the backup copy of the
+    previous checkpoint file kept beside it; if that can't be read either, report
+    that we're restarting from scratch. Then apply any progress recorded in the
+    journal that accompanies the checkpoint file.
+
+    Checkpoint files written by older versions, which are bzip2-compressed pickled
+    sets rather than gzipped packed paths, can still be loaded.
+    """
+    global solutions, exhausted_paths, total_paths_exhausted_num, run_start, journaled_solutions
+
+    load_from = [checkpoint_path] + ([_backup_path()] if _backup_path().exists() else [])
+    for load_path in load_from:
+        util.log_it(f"  ... opening progress file {load_path.name} ...", util.VERBOSITY_REPORT_PROGRESS_ON_SAVE)
+        try:
+            with open(load_path, mode='rb') as checkpoint_file:
+                old_format = (checkpoint_file.read(3) == b'BZh')        # bzip2's magic number
+            with (bz2.open if old_format else gzip.open)(load_path, mode='rb') as checkpoint_file:
+                data = pickle.load(checkpoint_file)
+            solutions = data['solutions'] if old_format else _unpack_paths(data['solutions'])
+            exhausted_paths = data['exhausted_paths'] if old_format else _unpack_paths(data['exhausted_paths'])
+            total_paths_exhausted_num = data['num_exhausted']
+            run_start = time.monotonic() - data['total_time']
+            journaled_solutions = set(solutions)
+            print(f"  ... data loaded from {load_path.name}!")
+            break
+        except (IOError, EOFError, KeyError, pickle.PickleError) as errrr:
+            print(f"Warning! Cannot load progress data from {load_path.name}; the system said: {errrr}")
+    else:
         print("Starting from scratch.")
 
+    _replay_journal()
+
 
-cdef bint path_is_pruned(bytearray path) except? 127:        # 127 should never be a value that the function returns
+cdef bint path_is_pruned(const unsigned char *path, int path_length) except? 127:        # 127 should never be a value that the function returns
     """Return True if this is a path that we have already explored, e.g. in a previous
-    run.
+    run. PATH_LENGTH is the number of steps in PATH, which the caller always knows,
+    so there's no need to scan PATH to find it.
+
+    This checks every prefix of PATH, so _solve_from() only calls it once, on the steps
+    it was handed. After that, each new step only needs to check the whole path: every
+    shorter prefix was already checked when its own last step was taken.
     """
     global exhausted_paths
 
     if not exhausted_paths: return False
 
-    for length in range(1, 1 + len([node for node in path if node])):
-        if bytes(path[:length]) in exhausted_paths:
+    for length in range(1, 1 + path_length):
+        if path[:length] in exhausted_paths:
             return True
     return False
 
 
-cdef void _solve_from(dict paths_to_nodes,       # Dict[int, Tuple[int]]
-                      dict nodes_to_paths,       # Dict[int, Tuple[int]]
+cdef inline void _toggle_path(uint64_t *visited, int path) noexcept nogil:
+    """Flip PATH's bit in the VISITED bitmask: mark it as used if it wasn't, or as
+    available again if it was.
+    """
+    visited[path >> 6] ^= (<uint64_t>1) << (path & 63)
+
+
+cdef extern from *:
+    """
+    #if defined(_MSC_VER)
+    #include <intrin.h>
+    static __inline int koenigsberg_ctz64(unsigned __int64 bits) {
+        unsigned long index;
+        _BitScanForward64(&index, bits);
+        return (int)index;
+    }
+    #else
+    #define koenigsberg_ctz64(bits) __builtin_ctzll(bits)
+    #endif
+    """
+    int koenigsberg_ctz64(uint64_t bits) nogil                 # index of the lowest set bit; BITS must be nonzero
+
+
+cdef inline int _next_unused(const uint64_t *path_mask, const uint64_t *visited, int first, int num_words) noexcept nogil:
+    """Return the lowest path ID, no lower than FIRST, whose bit is set in PATH_MASK
+    but not in VISITED, looking only at the first NUM_WORDS words of each; or -1 if
+    there's no such path.
+    """
+    cdef int word = first >> 6
+    cdef uint64_t available
+
+    if word >= num_words:
+        return -1
+    available = path_mask[word] & ~visited[word] & ((~(<uint64_t>0)) << (first & 63))
+    while not available:
+        word += 1
+        if word >= num_words:
+            return -1
+        available = path_mask[word] & ~visited[word]
+    return (word << 6) + koenigsberg_ctz64(available)
+
+
+cdef bint _strands_paths(const graph_tables *tables, const uint64_t *visited, int num_words, int origin, int path) noexcept nogil:
+    """Return True if crossing PATH away from ORIGIN, given the paths already used
+    in VISITED, would leave ORIGIN with unused paths that can no longer be reached
+    from the far end of PATH, so that the search can't possibly cross all of them.
+    """
+    cdef uint64_t used[VISITED_WORDS]
+    cdef uint64_t seen[VISITED_WORDS]                       # bit N is set once node N has been reached
+    cdef unsigned char to_check[MAX_IDS]
+    cdef int num_to_check = 1
+    cdef int node, other, word
+    cdef uint64_t available
+    cdef bint origin_has_paths = False
+
+    memcpy(used, visited, num_words * 8)
+    _toggle_path(used, path)
+    for word in range(num_words):
+        if tables.path_masks[origin][word] & ~used[word]:
+            origin_has_paths = True
+            break
+    if not origin_has_paths:
+        return False                                            # Nothing left behind to strand.
+
+    memset(seen, 0, sizeof(seen))
+    node = origin ^ tables.other_end[path]
+    seen[node >> 6] |= (<uint64_t>1) << (node & 63)
+    to_check[0] = node
+    while num_to_check:                                         # Search outward from the far end for a way back.
+        num_to_check -= 1
+        node = to_check[num_to_check]
+        for word in range(num_words):
+            available = tables.path_masks[node][word] & ~used[word]
+            while available:
+                other = node ^ tables.other_end[(word << 6) + koenigsberg_ctz64(available)]
+                if other == origin:
+                    return False
+                if not ((seen[other >> 6] >> (other & 63)) & 1):
+                    seen[other >> 6] |= (<uint64_t>1) << (other & 63)
+                    to_check[num_to_check] = other
+                    num_to_check += 1
+                available &= available - 1
+    return True
+
+
+cdef inline bytes _state_key(const uint64_t *visited, int num_words, int node):
+    """Pack the first NUM_WORDS words of the VISITED bitmask, plus the NODE we're
+    standing on, into a bytes object that identifies the current state of the
+    search, for use as a key in the set of known dead ends.
+    """
+    cdef unsigned char key[VISITED_WORDS * 8 + 1]
+
+    memcpy(key, visited, num_words * 8)
+    key[num_words * 8] = node
+    return key[:num_words * 8 + 1]
+
+
+cdef graph_tables *_build_graph_tables(dict paths_to_nodes,       # Dict[int, Tuple[int]]
+                                       dict nodes_to_paths        # Dict[int, Tuple[int]]
+                                       ) except NULL:
+    """Flattens the normalized PATHS_TO_NODES and NODES_TO_PATHS dictionaries into a
+    newly allocated GRAPH_TABLES struct of C arrays, which _solve_from() can read
+    without touching any Python objects. The caller is responsible for releasing
+    the struct with PyMem_Free() when it's no longer needed.
+    """
+    cdef graph_tables *tables = <graph_tables *>PyMem_Malloc(sizeof(graph_tables))
+    cdef int i
+
+    if not tables:
+        raise MemoryError("Unable to allocate memory for the graph being solved!")
+    memset(tables, 0, sizeof(graph_tables))
+
+    try:
+        tables.num_paths = len(paths_to_nodes)
+        tables.num_words = 1
+        for path, (first, second) in paths_to_nodes.items():
+            if not all(0 < i < MAX_IDS for i in (path, first, second)):
+                raise ValueError(f"Path {path} (connecting nodes {first} and {second}) uses an ID outside the range 1 to {MAX_IDS - 1}! Use normalize_dicts() to assign IDs.")
+            tables.other_end[path] = first ^ second
+            tables.num_words = max(tables.num_words, (path >> 6) + 1)     # Path IDs needn't be contiguous; cover the highest.
+        for node, path_list in nodes_to_paths.items():
+            if not (0 < node < MAX_IDS):
+                raise ValueError(f"Node {node} has an ID outside the range 1 to {MAX_IDS - 1}! Use normalize_dicts() to assign IDs.")
+            for path in path_list:
+                if path not in paths_to_nodes:
+                    raise ValueError(f"Path {path}, leading out of node {node}, isn't listed in PATHS_TO_NODES!")
+                tables.path_masks[node][path >> 6] |= (<uint64_t>1) << (path & 63)
+    except BaseException:
+        PyMem_Free(tables)
+        raise
+
+    return tables
+
+
+cdef void _solve_from(graph_tables *tables,
                       int start_from,
                       bytearray steps_taken,
-                      int num_steps_taken) except *:
-    """Recursively calls itself to solve the map described by PATHS_TO_NODES and
-    NODES_TO_PATHS, starting from START_FROM, having already taken NUM_STEPS_TAKEN
-    steps, which are recorded in the STEPS_TAKEN array. STEPS_TAKEN must be
-    preallocated (and filled with zeroes) and is shared by each recursive invocation
-    of this function; it's a scratch space that gets passed around, and copies of it
-    are formatted and printed when they turn into successful results.
+                      int num_steps_taken,
+                      set dead_ends=None,
+                      list found=None) except *:
+    """Solves the map described by TABLES, starting from START_FROM, having already
+    taken NUM_STEPS_TAKEN steps, which are recorded in the STEPS_TAKEN array.
+    STEPS_TAKEN must be preallocated (and filled with zeroes after the steps already
+    taken); it's a scratch space that is overwritten as the search proceeds, and
+    copies of it are formatted and printed when they turn into successful results.
+
+    The search is depth-first, but it's performed iteratively, using an explicit
+    stack, rather than by having this function call itself recursively: NODE_STACK
+    holds the node we're standing on at each DEPTH, and POSITION_STACK holds the
+    lowest path ID that's still worth trying from there.
+    Paths that have already been traversed are tracked in VISITED, a 256-bit mask
+    (stored as four 64-bit words) in which bit N is set if path N has been used.
+    Masking it out of the node's own mask of paths in TABLES leaves the paths still
+    available from that node, so finding the next one to take is a few word-sized
+    operations instead of a scan through STEPS_TAKEN, which is only used to record
+    the order of steps. Paths leading out of a node are tried in order of their IDs.
+
+    If DEAD_ENDS is a set, it's used to remember states of the search -- a node
+    plus the set of paths used to get there, in whatever order -- from which every
+    onward route was explored without completing a solution, so that reaching the
+    same state again by crossing the same paths in a different order can be
+    abandoned immediately. The same set can be passed to multiple calls on the same
+    map. It's ignored while EXHAUSTED_PATHS is being tracked, because paths skipped
+    as already explored may have led to solutions in an earlier run. States with
+    fewer than DEAD_END_MIN_REMAINING paths left to cross aren't remembered: what's
+    left to explore from them is small enough that exploring it again is cheaper
+    than looking them up every time they're reached.
+
+    When DEAD_ENDS isn't being used, each step is checked before it's taken to see
+    whether it would leave paths behind that can no longer be reached from where
+    the step leads. Searching onward from there can't turn up a solution, so the
+    search treats the far end of the step as a dead end as soon as it arrives; it's
+    still recorded, reported, and checkpointed like any other abandoned path. That
+    check costs more than it saves when DEAD_ENDS is in use, because the known dead
+    ends already cut off most of those searches after they've been explored once.
+
+    If FOUND is a list, each solution is also appended to it, in the order found.
 
     Prints nothing if there are no successful results.
     Makes no attempts to verify that the data is sane -- call _sanity_check_dicts()
@@ -215,42 +577,110 @@ cdef void _solve_from(dict paths_to_nodes,       # Dict[int, Tuple[int]]
     global exhausted_paths, solutions
     global exhausted_paths_prune_threshold, paths_length_at_last_prune, total_paths_exhausted_num
 
-    if num_steps_taken == len(paths_to_nodes):                  # if we've hit every path ... we have a solution!
-        sol = bytes([s for s in steps_taken if s])              # create a copy of the current path
-        solutions.add(sol)                                      # add it to the set of solutions
-        print(output_func(steps_taken, num_steps_taken))        # print it
-
-    else:                                                       # We have not explored every possible path on this journey.
-        next_steps = [p for p in nodes_to_paths[start_from] if p not in steps_taken]
-        if next_steps:
-            for next_path in sorted(next_steps):
-                next_loc = [p for p in paths_to_nodes[next_path] if p != start_from][0]
-                steps_taken[num_steps_taken] = next_path        # The step we're taking right now.
-                if (not exhausted_paths) or (not path_is_pruned(steps_taken)):
-                    _solve_from(paths_to_nodes, nodes_to_paths, next_loc, steps_taken, 1+num_steps_taken)
-                steps_taken[num_steps_taken] = 0                # Free up the space for the step we just took
+    cdef unsigned char *steps = steps_taken                     # C-level view of STEPS_TAKEN's buffer
+    cdef int num_paths = tables.num_paths
+    cdef int base_num_steps = num_steps_taken
+    cdef int next_path, pos
+    cdef int node_stack[MAX_IDS]                                # Never deeper than the (at most 255) paths in the map
+    cdef int position_stack[MAX_IDS]                            # lowest path ID not yet tried from each depth's node
+    cdef long found_stack[MAX_IDS]                              # value of NUM_FOUND when we arrived at each depth
+    cdef long num_found = 0                                     # solutions found during this call
+    cdef int num_words = tables.num_words                       # words of VISITED that can have any bits set
+    cdef int depth = 0                                          # index of the top of the stack
+    cdef bint just_arrived = True
+    cdef bint tracking_exhausted = exhausted_paths is not None  # Only consult EXHAUSTED_PATHS if we're tracking them.
+    cdef bint report_abandoned = util.verbosity >= util.VERBOSITY_REPORT_SELECTED_ABANDONED_PATHS
+    cdef bint report_all_abandoned = util.verbosity >= util.VERBOSITY_REPORT_ALL_ABANDONED_PATHS
+    cdef bint use_dead_ends = (dead_ends is not None) and (not tracking_exhausted)
+    cdef bint check_stranding = not use_dead_ends               # look ahead for stranded paths if DEAD_ENDS can't help
+    cdef bint stranded = False                                  # the step just taken left paths that can't be reached
+    cdef int memo_depth_limit = num_paths - dead_end_min_remaining     # memoize only states reached in fewer steps
+
+    cdef uint64_t visited[VISITED_WORDS]                        # bit N is set if path N has been traversed
+
+    memset(visited, 0, sizeof(visited))
+    for pos in range(num_steps_taken):
+        _toggle_path(visited, steps[pos])
+
+    if tracking_exhausted and path_is_pruned(steps, num_steps_taken):      # Everything past the steps we were handed has been explored.
+        return
 
+    node_stack[0], position_stack[0], found_stack[0] = start_from, 0, 0
+    while depth >= 0:
+        start_from = node_stack[depth]
+        if stranded:                                            # Nothing onward from here can be a solution.
+            next_path = -1
+            stranded = False
+        else:                                                   # Find the next path out of here we haven't used yet.
+            next_path = _next_unused(tables.path_masks[start_from], visited, position_stack[depth], num_words)
+
+        if next_path < 0:                                   # Nowhere (else) to go from here.
+            if just_arrived:
+                if num_steps_taken == num_paths:                # if we've hit every path ... we have a solution!
+                    num_found += 1
+                    sol = steps[:num_steps_taken]               # create a copy of the current path
+                    solutions.add(sol)                          # add it to the set of solutions
+                    if found is not None:
+                        found.append(sol)
+                    if on_solution is None:
+                        print(output_func(steps_taken, num_steps_taken))    # print it
+                    else:
+                        on_solution(sol)                        # or hand it off to whoever wants it
+
+                else:                                           # We're stuck before having explored every path.
+                    total_paths_exhausted_num += 1
+                    if tracking_exhausted:
+                        exhausted = steps[:num_steps_taken]
+                        exhausted_paths.add(exhausted)
+                        unsaved_exhausted_paths.append(exhausted)
+                        if len(exhausted_paths) > (exhausted_paths_prune_threshold + paths_length_at_last_prune):
+                            do_prune_exhausted_paths_list()
+
+                    if report_abandoned:                        # Skip all of this formatting unless it'll be printed.
+                        # The verbosity level has already been checked, so these print directly instead of calling util.log_it().
+                        if (total_paths_exhausted_num % abandoned_paths_number_report_interval) == 0:
+                            print(f"  {total_paths_exhausted_num / 1000000:.6f} million exhausted paths")
+
+                        if report_all_abandoned or ((num_steps_taken % abandoned_paths_length_report_interval) == 0):
+                            print(f"{indents[num_steps_taken]} abandoned path {output_func(steps_taken, num_steps_taken)}.")
+                    if exhausted_paths and ((num_steps_taken % checkpoint_interval) == 0):
+                        do_save()
+
+            elif use_dead_ends and (num_steps_taken <= memo_depth_limit) and (num_found == found_stack[depth]):
+                # Explored onward from here, but found nothing.
+                if len(dead_ends) >= dead_end_cache_limit:
+                    dead_ends.clear()
+                dead_ends.add(_state_key(visited, num_words, start_from))
+
+            depth -= 1                                          # Back up one step.
+            if num_steps_taken > base_num_steps:
+                num_steps_taken -= 1
+                _toggle_path(visited, steps[num_steps_taken])
+                steps[num_steps_taken] = 0                      # Free up the space for the step we just backed out of
+            just_arrived = False
+            continue
+
+        position_stack[depth] = next_path + 1                   # Next time we're back at this depth, try the next path.
+        steps[num_steps_taken] = next_path                      # The step we're taking right now.
+        # Every shorter prefix of this path was checked when its last step was taken, so only the whole path needs checking.
+        if (not tracking_exhausted) or (steps[:num_steps_taken + 1] not in exhausted_paths):
+            stranded = check_stranding and _strands_paths(tables, visited, num_words, start_from, next_path)
+            _toggle_path(visited, next_path)
+            num_steps_taken += 1
+            depth += 1
+            node_stack[depth] = start_from ^ tables.other_end[next_path]
+            position_stack[depth] = 0
+            found_stack[depth] = num_found
+            just_arrived = True
+            if use_dead_ends and (num_steps_taken <= memo_depth_limit) and (_state_key(visited, num_words, node_stack[depth]) in dead_ends):
+                depth -= 1                                      # Been here before, and it went nowhere. Back out.
+                num_steps_taken -= 1
+                _toggle_path(visited, next_path)
+                steps[num_steps_taken] = 0
+                just_arrived = False
         else:
-            total_paths_exhausted_num += 1
-            if exhausted_paths is not None:
-                exhausted_paths.add(bytes((s for s in steps_taken if s)))
-                if len(exhausted_paths) > (exhausted_paths_prune_threshold + paths_length_at_last_prune):
-                    do_prune_exhausted_paths_list()
-
-            if (total_paths_exhausted_num % abandoned_paths_number_report_interval) == 0:
-                util.log_it(f"  {total_paths_exhausted_num / 1000000:.6f} million exhausted paths",
-                            util.VERBOSITY_REPORT_SELECTED_ABANDONED_PATHS)
-
-            if (num_steps_taken % abandoned_paths_length_report_interval) == 0:
-                util.log_it(f"{' ' * len([b for b in steps_taken if b])} abandoned path {output_func(steps_taken, num_steps_taken)}.",
-                            util.VERBOSITY_REPORT_SELECTED_ABANDONED_PATHS)
-            # Calculating a textual representation of a path is time-consuming, so we pre-test the verbosity level
-            # before dispatching to a function that calls the path-formatting function
-            elif util.verbosity >= util.VERBOSITY_REPORT_ALL_ABANDONED_PATHS:
-                util.log_it(f"{' ' * len([b for b in steps_taken if b])} abandoned path {output_func(steps_taken, num_steps_taken)}.",
-                            util.VERBOSITY_REPORT_ALL_ABANDONED_PATHS)
-            if exhausted_paths and ((num_steps_taken % checkpoint_interval) == 0):
-                do_save()
+            steps[num_steps_taken] = 0
+            just_arrived = False
 
 
 def solve_from(paths_to_nodes: Dict[int, Tuple[int]],
@@ -260,8 +690,154 @@ def solve_from(paths_to_nodes: Dict[int, Tuple[int]],
     of a bytearray and it takes fewer parameters because it does not call itself
     recursively.
     """
-    steps_taken = bytearray([0] * len(paths_to_nodes))
-    _solve_from(paths_to_nodes, nodes_to_paths, start_from, steps_taken, 0)
+    cdef graph_tables *tables = _build_graph_tables(paths_to_nodes, nodes_to_paths)
+
+    try:
+        steps_taken = bytearray(len(paths_to_nodes))                  # zero-filled
+        _solve_from(tables, start_from, steps_taken, 0, set())
+    finally:
+        PyMem_Free(tables)
+
+
+def _odd_degree_nodes(paths_to_nodes: Dict[int, Tuple[int]],
+                      nodes_to_paths: Dict[int, Tuple[int]]) -> Tuple[Dict[int, int], List[int]]:
+    """Counts the path-ends touching each node, and returns a tuple: (a dictionary
+    mapping each node to that count; a list of the nodes for which it's odd, in the
+    order in which they occur in NODES_TO_PATHS).
+    """
+    degree = {node: 0 for node in nodes_to_paths}
+    for first, second in paths_to_nodes.values():
+        degree[first] += 1
+        degree[second] += 1
+    return degree, [node for node in nodes_to_paths if degree[node] % 2]
+
+
+def _euler_precheck(paths_to_nodes: Dict[int, Tuple[int]],
+                    nodes_to_paths: Dict[int, Tuple[int]]) -> List[int]:
+    """Uses Euler's theorem to determine which nodes a solution can possibly start
+    from, and returns a list of them, which is empty if the map has no solutions at
+    all. A trail crossing every path exactly once exists only if all of the paths
+    are connected to each other and either zero or two nodes have an odd number of
+    path-ends touching them. If there are no such nodes, a solution can start
+    anywhere; if there are two, every solution starts at one of them and ends at
+    the other.
+
+    Nodes are returned in the same order in which they occur in NODES_TO_PATHS.
+    """
+    degree, odd_nodes = _odd_degree_nodes(paths_to_nodes, nodes_to_paths)
+    if len(odd_nodes) not in (0, 2):
+        return list()
+
+    if paths_to_nodes:                      # Can every path be reached from the first one?
+        reached_nodes, to_visit = set(), [next(iter(paths_to_nodes.values()))[0]]
+        while to_visit:
+            node = to_visit.pop()
+            if node not in reached_nodes:
+                reached_nodes.add(node)
+                to_visit.extend(n for path in nodes_to_paths[node] for n in paths_to_nodes[path])
+        if any(node not in reached_nodes for node in degree if degree[node]):
+            return list()
+
+    return odd_nodes or [node for node in nodes_to_paths if degree[node]]
+
+
+def _worker_settings() -> tuple:
+    """Collects the module-level settings that affect how _solve_from() runs into a
+    tuple that can be handed to _solve_from_worker(), below, in another process.
+    Raises ValueError if OUTPUT_FUNC can't be sent to another process.
+    """
+    try:
+        pickle.dumps(output_func)
+    except (pickle.PicklingError, AttributeError, TypeError) as errrr:
+        raise ValueError(f"The path formatter {output_func!r} can't be pickled, so it can't be sent to worker processes! Use a module-level function or the formatter returned by util.default_path_formatter(), or set num_jobs to 1.") from errrr
+    return (util.verbosity, output_func,
+            abandoned_paths_length_report_interval, abandoned_paths_number_report_interval,
+            dead_end_min_remaining, dead_end_cache_limit)
+
+
+def _solve_from_worker(paths_to_nodes: Dict[int, Tuple[int]],
+                       nodes_to_paths: Dict[int, Tuple[int]],
+                       start_from: int,
+                       first_path: int,
+                       parent_settings: tuple) -> Tuple[List[bytes], int]:
+    """Runs in a worker process started by _solve_in_parallel(), below: solves the map
+    from START_FROM, considering only solutions whose first step is FIRST_PATH, and
+    returns a tuple: (a list of the solutions found, in the order they were found;
+    the number of paths exhausted along the way). PARENT_SETTINGS is the tuple
+    returned by _worker_settings() in the parent process; it's passed in explicitly
+    because worker processes don't necessarily inherit the parent's module state.
+    """
+    global output_func, on_solution, solutions, exhausted_paths, total_paths_exhausted_num
+    global abandoned_paths_length_report_interval, abandoned_paths_number_report_interval
+    global dead_end_min_remaining, dead_end_cache_limit
+    cdef graph_tables *tables
+
+    found = list()
+    (util.verbosity, output_func,
+     abandoned_paths_length_report_interval, abandoned_paths_number_report_interval,
+     dead_end_min_remaining, dead_end_cache_limit) = parent_settings
+    on_solution = found.append
+    solutions, exhausted_paths, total_paths_exhausted_num = set(), None, 0
+
+    first, second = paths_to_nodes[first_path]
+    tables = _build_graph_tables(paths_to_nodes, nodes_to_paths)
+    try:
+        steps_taken = bytearray(len(paths_to_nodes))                  # zero-filled
+        steps_taken[0] = first_path
+        _solve_from(tables, second if (first == start_from) else first, steps_taken, 1, set())
+    finally:
+        PyMem_Free(tables)
+
+    return found, total_paths_exhausted_num
+
+
+def _emit_reversed_solutions(found: List[bytes]) -> None:
+    """Record and print (or pass to ON_SOLUTION) the reverse of each solution in
+    FOUND. When the map has exactly two odd-degree nodes, every solution starts at
+    one and ends at the other, so the solutions from the second are exactly the
+    reverses of those from the first. Since paths are tried in order of their IDs,
+    searching from the second would have produced them in sorted order, so they're
+    emitted in that order.
+    """
+    reversed_solutions = sorted(sol[::-1] for sol in found)
+    solutions.update(reversed_solutions)
+    if on_solution is not None:
+        for sol in reversed_solutions:
+            on_solution(sol)
+    elif reversed_solutions:
+        print('\n'.join(util.format_paths(output_func, reversed_solutions)))
+
+
+def _solve_in_parallel(paths_to_nodes: Dict[int, Tuple[int]],
+                       nodes_to_paths: Dict[int, Tuple[int]],
+                       starts_from: List[int]) -> None:
+    """Split the search from each of the STARTS_FROM into separate tasks, one for
+    each path leading out of the starting point, and spread those tasks across
+    NUM_JOBS worker processes. Splitting after the first step, rather than just
+    handing out starting points, keeps workers busy when some starting points have
+    much more to explore than others: an idle worker just takes the next task.
+
+    Then record and print (or pass to ON_SOLUTION) the solutions found by each task
+    in the order the tasks were created, so that output is the same as it would have
+    been if everything had been solved one step after another in this process. Each
+    task's solutions are printed with a single call to print().
+    """
+    global total_paths_exhausted_num
+
+    settings = _worker_settings()
+    jobs = [(start, path) for start in starts_from for path in sorted(set(nodes_to_paths[start]))]     # in the order _solve_from() tries them
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(num_jobs, len(jobs))) as executor:
+        tasks = [executor.submit(_solve_from_worker, paths_to_nodes, nodes_to_paths, start, path, settings)
+                 for start, path in jobs]
+        for task in tasks:
+            found, num_exhausted = task.result()
+            total_paths_exhausted_num += num_exhausted
+            solutions.update(found)
+            if on_solution is not None:
+                for sol in found:
+                    on_solution(sol)
+            elif found:
+                print('\n'.join(util.format_paths(output_func, found)))
 
 
 def solve_from_multiple(paths_to_nodes: Dict[int, Tuple[int]],
@@ -271,13 +847,52 @@ def solve_from_multiple(paths_to_nodes: Dict[int, Tuple[int]],
     by NODES_TO_PATHS by starting from all of the paths in STARTS_FROM, an iterable
     of starting locations.
 
+    If NUM_JOBS is more than one, the search is split up and solved simultaneously
+    in separate worker processes. This doesn't happen when progress is being
+    tracked for checkpointing, because that progress is kept in this process's
+    globals.
+
+    Starting points from which Euler's theorem shows that no solution can begin are
+    skipped without being searched.
+
+    If the map has two odd-degree nodes, both are requested, and EXHAUSTED_PATHS is
+    being tracked, only the first is searched; the solutions from the second are
+    the reverses of those, and are produced by reversing them. Otherwise, both are
+    searched: without progress tracking, the known dead ends from the first search
+    make the second one cheaper than sorting the reversed solutions would be.
+
     It is unlikely, but possible in theory, that this function may emit "the same
     solution" more than once if it's possible to follow the same sequence of paths
     from different starting points.
     """
-    steps_taken = bytearray([0] * len(paths_to_nodes))
-    for start in starts_from:
-        _solve_from(paths_to_nodes, nodes_to_paths, start, steps_taken, 0)
+    cdef graph_tables *tables
+
+    possible_starts = set(_euler_precheck(paths_to_nodes, nodes_to_paths))
+    starts_from = [start for start in starts_from if start in possible_starts]
+    if not starts_from:
+        util.log_it("  ... no solution can begin at any of the requested starting points!", util.VERBOSITY_FRIENDLY_PROGRESS_CHATTER)
+        return
+
+    if (num_jobs > 1) and (exhausted_paths is None):
+        _solve_in_parallel(paths_to_nodes, nodes_to_paths, starts_from)
+        return
+
+    mirror_solutions = (exhausted_paths is not None) and (len(starts_from) == 2) and (len(_odd_degree_nodes(paths_to_nodes, nodes_to_paths)[1]) == 2)
+    if mirror_solutions:
+        starts_from = starts_from[:1]
+
+    tables = _build_graph_tables(paths_to_nodes, nodes_to_paths)
+    try:
+        steps_taken = bytearray(len(paths_to_nodes))                  # zero-filled
+        dead_ends = set()                                   # Dead ends don't depend on where the search started.
+        found = list() if mirror_solutions else None
+        for start in starts_from:
+            _solve_from(tables, start, steps_taken, 0, dead_ends, found)
+    finally:
+        PyMem_Free(tables)
+
+    if mirror_solutions:
+        _emit_reversed_solutions(found)
 
 
 def solve_from_all(paths_to_nodes: Dict[int, Tuple[int]],
@@ -291,17 +906,20 @@ def solve_from_all(paths_to_nodes: Dict[int, Tuple[int]],
 
 def print_all_dict_solutions(paths_to_nodes: dict, 
                              nodes_to_paths: dict,
-                             path_formatter: typing.Optional[typing.Callable[[int], str]] = None) -> None:
+                             path_formatter: typing.Optional[typing.Callable[[int], str]] = None,
+                             sanity_checked: bool = False) -> None:
     """Friendly interface that bundles together all of the various components of a
     generic solution that works fine for many purposes much of the time. It takes a
     PATHS_TO_NODES and a NODES_TO_PATHS dictionary.
 
     Given those parameters, it normalizes the dictionaries, finds all solutions, and
-    prints them using the default solution formatter.
+    prints them using the default solution formatter. Pass SANITY_CHECKED=True if
+    the dictionaries have already been through util._sanity_check_dicts(), so that
+    the check isn't repeated.
     """
     global output_func
 
-    p, n, p_trans, n_trans, p_trans_rev, n_trans_rev = util.normalize_dicts(paths_to_nodes, nodes_to_paths)
+    p, n, p_trans, n_trans, p_trans_rev, n_trans_rev = util.normalize_dicts(paths_to_nodes, nodes_to_paths, sanity_checked=sanity_checked)
     output_func = path_formatter or util.default_path_formatter(p_trans)
 
     solve_from_all(p, n)
@@ -314,7 +932,8 @@ def print_all_dict_solutions(paths_to_nodes: dict,
 
 
 def print_single_dict_solutions(single_dict: dict,
-                                path_formatter: typing.Optional[typing.Callable[[int], str]] = None) -> None:
+                                path_formatter: typing.Optional[typing.Callable[[int], str]] = None,
+                                sanity_checked: bool = False) -> None:
     """Friendly, high-level interface to print_all_dict_solutions; a convenience
     function for command-line use that takes  SINGLE_DICT, a parameter that bundles
     together both dictionaries describing a map into a single dictionary with the
@@ -325,16 +944,21 @@ def print_single_dict_solutions(single_dict: dict,
         'paths to nodes': {  [ a valid paths_to_nodes dictionary ]  }
     }
     """
-    print_all_dict_solutions(single_dict['paths to nodes'], single_dict['nodes to paths'], path_formatter)
+    print_all_dict_solutions(single_dict['paths to nodes'], single_dict['nodes to paths'], path_formatter, sanity_checked)
 
 
 def print_all_graph_solutions(graph: dict,
-                              path_formatter: typing.Optional[typing.Callable[[int], str]] = None) -> None:
+                              path_formatter: typing.Optional[typing.Callable[[int], str]] = None,
+                              sanity_checked: bool = False) -> None:
     """Friendly interface that takes a graph, as defined in graph_to_dicts(), and
     finds, then prints, all solutions from any point, just as
-    print_all_dict_solutions(), above, does for maps represented by dicts.
+    print_all_dict_solutions(), above, does for maps represented by dicts. Pass
+    SANITY_CHECKED=True if GRAPH has already been through util._sanity_check_graph().
+    The dictionaries built from the graph are still checked, because a sane graph
+    can still produce dictionaries that fail those checks (e.g., if it has a node
+    with no connections).
     """
-    p_to_n, n_to_p = util.graph_to_dicts(graph)
+    p_to_n, n_to_p = util.graph_to_dicts(graph, sanity_checked)
     print_all_dict_solutions(p_to_n, n_to_p, path_formatter)
 
 
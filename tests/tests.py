@@ -8,11 +8,20 @@ version. See the file LICENSE.md for details.
 """
 
 
+import contextlib
+import io
+import tempfile
+import time
 import unittest
+import unittest.mock
+
+from pathlib import Path
+from typing import Dict, List, Tuple
 
 import koenigsberg
 import koenigsberg_lib as kl
 import util
+import wizard_lib
 
 
 def limited_koenigsberg_sample_test() -> None:
@@ -20,13 +29,18 @@ def limited_koenigsberg_sample_test() -> None:
     p, n, p_trans, n_trans, p_trans_rev, n_trans_rev = util.normalize_dicts(sd['paths to nodes'], sd['nodes to paths'])
     formatter = util.default_path_formatter(p_trans)
 
-    sol_found = False
-    for i, path in enumerate(kl.solve_from(p, n, n_trans_rev['A'], formatter), 1):
-        print(f"Solution #{i}: \t {formatter(path, len(p))}")
-        sol_found = True
+    found = list()
+    kl.reset_data(confirm=True)
+    kl.on_solution = found.append
+    try:
+        kl.solve_from(p, n, n_trans_rev['A'])
+    finally:
+        kl.on_solution = None
 
+    if found:       # All of the solutions in a single write, rather than one print() call apiece.
+        print('\n'.join(f"Solution #{i}: \t {formatter(bytearray(path), len(p))}" for i, path in enumerate(found, 1)))
     print("All paths examined!")
-    if not sol_found:
+    if not found:
         print("    No solutions found!")
 
 
@@ -97,6 +111,234 @@ class TestDataSanityChecks(unittest.TestCase):
             util._sanity_check_dicts(paths_to_nodes={(1, 2): (1, 2), (1, 4): (1, 4), (2, 3): (2, 3)},
                                      nodes_to_paths={1: ((1, 2), (1, 4)), 2: ((1, 2), (2, 3)), 3: ((2, 3), (3, 4)), 4: ((1, 4), (3, 4))})
 
+    def test_flatten_list(self) -> None:
+        # strings and bytes count as atoms, but any other iterable is flattened, however deeply it's nested
+        self.assertEqual(list(util.flatten_list([1, [2, [3, [4, 'ab']], b'x'], (5,), [], [[[]]], 6])), [1, 2, 3, 4, 'ab', b'x', 5, 6])
+        deeply_nested = ['bottom']
+        for _ in range(5000):
+            deeply_nested = [deeply_nested]
+        self.assertEqual(list(util.flatten_list([deeply_nested])), ['bottom'])
+
+    def test_flatten_into(self) -> None:
+        nested = [1, [2, [3, [4, 'ab']], b'x'], (5,), [], [[[]]], 6]
+        self.assertEqual(util.flatten_into(nested), list(util.flatten_list(nested)))
+        out = ['already here']
+        self.assertIs(util.flatten_into([[7], 8], out), out)
+        self.assertEqual(out, ['already here', 7, 8])
+
+    def test_format_paths(self) -> None:
+        formatter = util.default_path_formatter({1: 'a', 2: 'b', 3: 'c'})
+        paths = [b'\x01\x02\x03', b'\x03\x01\x00']
+        self.assertEqual(util.format_paths(formatter, paths), ['a -> b -> c', 'c -> a'])
+        self.assertEqual(util.format_paths(lambda path, length: bytes(path).hex(), paths), ['010203', '030100'])
+        self.assertRaises(KeyError, formatter, b'\x01\x04', 2)     # path 4 has no name
+
+
+class TestSolver(unittest.TestCase):
+    def setUp(self) -> None:
+        util.verbosity = util.VERBOSITY_MINIMAL
+        self.saved_settings = (kl.checkpoint_path, kl.min_save_interval, kl.on_solution, kl.num_jobs, kl.output_func)
+        kl.reset_data(confirm=True)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.checkpoint_file = Path(temp_dir.name) / 'progress.dat'
+
+    def tearDown(self) -> None:
+        kl.checkpoint_path, kl.min_save_interval, kl.on_solution, kl.num_jobs, kl.output_func = self.saved_settings
+        kl.reset_data(confirm=True)
+
+    def use_checkpoint_file(self) -> None:
+        """Track progress in a checkpoint file in a temporary directory, saving every
+        time a save is requested.
+        """
+        kl.checkpoint_path, kl.min_save_interval = self.checkpoint_file, 0
+
+    def count_graph_solutions(self, graph_file: str) -> int:
+        """Solve the graph in GRAPH_FILE from every starting point, suppressing the
+        printed output, and return the number of distinct solutions found.
+        """
+        kl.reset_data(confirm=True)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            kl.print_all_graph_solutions(koenigsberg.read_graph_file(graph_file))
+        return len([line for line in output.getvalue().split('\n') if ' -> ' in line])
+
+    def collect_solutions(self, paths_to_nodes: Dict[int, Tuple[int]], nodes_to_paths: Dict[int, Tuple[int]]) -> List[bytes]:
+        """Solve the normalized dicts from every starting point and return the list of
+        solutions, in the order they were found, instead of printing them.
+        """
+        found = list()
+        kl.on_solution = found.append
+        kl.solve_from_all(paths_to_nodes, nodes_to_paths)
+        return found
+
+    def test_known_solution_counts(self) -> None:
+        self.assertEqual(self.count_graph_solutions('sample_data/hex_ring.graph'), 12)
+        self.assertEqual(self.count_graph_solutions('sample_data/pentagon.graph'), 2640)
+        self.assertEqual(self.count_graph_solutions('sample_data/ten_spot_hexlike.graph'), 0)
+
+    def test_euler_precheck(self) -> None:
+        # a ring: no odd-degree nodes, so any node can start a solution
+        self.assertEqual(kl._euler_precheck({1: (1, 2), 2: (2, 3), 3: (1, 3)}, {1: (1, 3), 2: (1, 2), 3: (2, 3)}), [1, 2, 3])
+        # a line: only the two ends can start a solution
+        self.assertEqual(kl._euler_precheck({1: (1, 2), 2: (2, 3)}, {1: (1,), 2: (1, 2), 3: (2,)}), [1, 3])
+        # a star with three arms has four odd-degree nodes, so no solutions
+        self.assertEqual(kl._euler_precheck({1: (1, 2), 2: (1, 3), 3: (1, 4)}, {1: (1, 2, 3), 2: (1,), 3: (2,), 4: (3,)}), [])
+        # two separate rings can't be traversed in one trip
+        self.assertEqual(kl._euler_precheck({1: (1, 2), 2: (1, 2), 3: (3, 4), 4: (3, 4)}, {1: (1, 2), 2: (1, 2), 3: (3, 4), 4: (3, 4)}), [])
+
+    def test_solution_callback(self) -> None:
+        p, n, *_ = util.normalize_dicts(*util.graph_to_dicts(koenigsberg.read_graph_file('sample_data/hex_ring.graph')))
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            found = self.collect_solutions(p, n)
+        self.assertEqual(len(found), 12)
+        self.assertTrue(all(sorted(sol) == sorted(p) for sol in found))
+        self.assertNotIn(' -> ', output.getvalue())
+
+    def test_sparse_path_ids(self) -> None:
+        # path IDs needn't be contiguous; path 100 is in the second word of the visited-paths mask
+        found = list()
+        kl.on_solution = found.append
+        kl.solve_from({1: (1, 2), 100: (2, 3)}, {1: (1,), 2: (1, 100), 3: (100,)}, 1)
+        self.assertEqual(found, [bytes([1, 100])])
+
+    def test_checkpoint_journal(self) -> None:
+        self.use_checkpoint_file()
+        kl.exhausted_paths = {b'\x01\x02'}
+        kl.do_save()                                            # first save rewrites the checkpoint file ...
+        kl.exhausted_paths.add(b'\x03\x04\x05')
+        kl.unsaved_exhausted_paths.append(b'\x03\x04\x05')
+        kl.do_save()                                            # ... later ones append to the journal
+        self.assertTrue(kl._journal_path().exists())
+
+        kl.reset_data(confirm=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            kl.do_load_progress()
+        self.assertEqual(kl.exhausted_paths, {b'\x01\x02', b'\x03\x04\x05'})
+
+        kl.do_save()                                            # the first save of a resumed run compacts the journal
+        self.assertFalse(kl._journal_path().exists())
+
+    def test_damaged_journal(self) -> None:
+        self.use_checkpoint_file()
+        kl.exhausted_paths = {b'\x01\x02'}
+        kl.do_save()
+        for path in (b'\x03\x04\x05', b'\x06\x07\x08'):
+            kl.exhausted_paths.add(path)
+            kl.unsaved_exhausted_paths.append(path)
+            kl.do_save()                                        # each journal save appends its own gzip member
+            if path == b'\x03\x04\x05':
+                intact_length = kl._journal_path().stat().st_size
+        full_length = kl._journal_path().stat().st_size
+        with open(kl._journal_path(), mode='r+b') as journal_file:
+            journal_file.truncate((intact_length + full_length) // 2)    # chop the last entry in half
+
+        kl.reset_data(confirm=True)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            kl.do_load_progress()
+        self.assertIn('damaged', output.getvalue())
+        self.assertEqual(kl.exhausted_paths, {b'\x01\x02', b'\x03\x04\x05'})
+
+    def test_stale_journal(self) -> None:
+        # a journal left behind by a full save that was interrupted before deleting it mustn't turn the clock back
+        self.use_checkpoint_file()
+        kl.exhausted_paths = {b'\x01\x02'}
+        kl.do_save()
+        kl.unsaved_exhausted_paths.append(b'\x01\x02')
+        kl.do_save()
+        stale_journal = kl._journal_path().read_bytes()
+        kl.run_start = time.monotonic() - 1000                  # the checkpoint records 1000 seconds of work ...
+        kl.do_save(even_if_not_time=True)
+        kl._journal_path().write_bytes(stale_journal)
+
+        kl.reset_data(confirm=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            kl.do_load_progress()
+        self.assertGreaterEqual(time.monotonic() - kl.run_start, 1000)     # ... the stale journal much less
+
+    def test_checkpoint_backup(self) -> None:
+        self.use_checkpoint_file()
+        kl.exhausted_paths = {b'\x01\x02'}
+        kl.do_save()
+        kl.exhausted_paths.add(b'\x03\x04\x05')
+        kl.do_save(even_if_not_time=True)                       # the first checkpoint is now the backup
+        kl.checkpoint_path.unlink()
+
+        kl.reset_data(confirm=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            kl.do_load_progress()
+        self.assertEqual(kl.exhausted_paths, {b'\x01\x02'})
+
+    def test_tracked_solution_counts(self) -> None:
+        p, n, *_ = util.normalize_dicts(*util.graph_to_dicts(koenigsberg.read_graph_file('sample_data/pentagon.graph')))
+        kl.checkpoint_path = self.checkpoint_file
+        kl.exhausted_paths = set()                              # tracking progress looks ahead for stranded paths instead of caching dead ends
+        with contextlib.redirect_stdout(io.StringIO()):
+            found = self.collect_solutions(p, n)
+        self.assertEqual(len(set(found)), 2640)
+        self.assertTrue(kl.exhausted_paths)                     # paths cut short are still recorded as exhausted
+
+    def test_tracked_solution_order(self) -> None:
+        # two triangles joined by a bridge have two odd-degree nodes, so a tracked search derives one end's solutions from the other's
+        graph = {1: [2, 3, 4], 2: [1, 3], 3: [1, 2], 4: [1, 5, 6], 5: [4, 6], 6: [4, 5]}
+        p, n, *_ = util.normalize_dicts(*util.graph_to_dicts(graph))
+        kl.checkpoint_path = self.checkpoint_file
+        untracked = self.collect_solutions(p, n)
+        kl.reset_data(confirm=True)
+        kl.exhausted_paths = set()
+        tracked = self.collect_solutions(p, n)
+        self.assertEqual(len(untracked), 8)
+        self.assertEqual(untracked, tracked)
+
+    def test_parallel_solution_counts(self) -> None:
+        kl.num_jobs = 2
+        self.assertEqual(self.count_graph_solutions('sample_data/hex_ring.graph'), 12)
+        self.assertEqual(self.count_graph_solutions('sample_data/pentagon.graph'), 2640)
+
+    def test_parallel_solution_order(self) -> None:
+        # path lists needn't be sorted; tasks are still handed out in the order the serial search tries the paths
+        p, n, *_ = util.normalize_dicts(*util.graph_to_dicts(koenigsberg.read_graph_file('sample_data/hex_ring.graph')))
+        n = {node: tuple(reversed(paths)) for node, paths in n.items()}
+        serial = self.collect_solutions(p, n)
+        kl.reset_data(confirm=True)
+        kl.num_jobs = 2
+        parallel = self.collect_solutions(p, n)
+        self.assertEqual(len(serial), 12)
+        self.assertEqual(serial, parallel)
+
+    def test_parallel_needs_picklable_formatter(self) -> None:
+        kl.output_func = lambda path, path_length: str(path)
+        self.assertRaises(ValueError, kl._worker_settings)
+
+
+class TestMapWizard(unittest.TestCase):
+    def read_graph(self, typed: str) -> Tuple[Dict[str, List[str]], str]:
+        """Feed TYPED to get_graph_all_at_once() as if it had been typed or pasted in,
+        and return a tuple: (the graph it produced; everything it printed).
+        """
+        with unittest.mock.patch('sys.stdin', io.StringIO(typed)), contextlib.redirect_stdout(io.StringIO()) as output:
+            graph = wizard_lib.get_graph_all_at_once()
+        return graph, output.getvalue()
+
+    def test_node_names_with_spaces(self) -> None:
+        graph, _ = self.read_graph("New York City : Jersey City ;Long Island\n\n")
+        self.assertEqual(graph['New York City'], ['Jersey City', 'Long Island'])
+
+    def test_one_sided_connections_made_reciprocal(self) -> None:
+        graph, _ = self.read_graph("a: b; c\nb: a\n\n")
+        self.assertEqual(graph, {'a': ['b', 'c'], 'b': ['a'], 'c': ['a']})
+
+    def test_input_ends_at_blank_line(self) -> None:
+        graph, _ = self.read_graph("a: b\n   \nc: d\n")     # a line of nothing but spaces counts as blank
+        self.assertEqual(graph, {'a': ['b'], 'b': ['a']})
+        graph, _ = self.read_graph("a: b\nb: c")              # end of input, even mid-line, also ends the graph
+        self.assertEqual(graph, {'a': ['b'], 'b': ['a', 'c'], 'c': ['b']})
+
+    def test_malformed_lines_ignored(self) -> None:
+        graph, output = self.read_graph("a: b\nno colon here\n: b\nc:\n\n")
+        self.assertEqual(graph, {'a': ['b'], 'b': ['a']})
+        self.assertEqual(output.count('ERROR!'), 3)
+        self.assertIn("'no colon here'", output)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -9,11 +9,13 @@ version. See the file LICENSE.md for details.
 """
 
 
-import functools
 import sys
 import traceback
+import types
 
-from typing import Any, Callable, Dict, Generator, Hashable, Iterable, Optional, Tuple, Union, Type
+from typing import Any, Callable, Dict, Generator, Hashable, Iterable, List, Optional, Tuple, Union, Type
+
+cimport cython
 
 
 # First, verbosity levels.
@@ -26,7 +28,28 @@ VERBOSITY_REPORT_EVERYTHING = 5
 
 
 # Global variables that control message printing
-cdef long verbosity = 1
+verbosity = 1                   # a Python-level global, not a cdef one, so that other modules can set and read it
+
+
+# Checked before falling back on the (much slower) isinstance(x, Iterable) test in flatten_list().
+_atom_types = (str, bytes, bytearray)
+_container_types = (list, tuple, set, frozenset, dict, range, types.GeneratorType)
+_is_iterable_type = dict()      # type -> bool; caches the result of the slow test for types not listed above
+
+
+cdef inline bint _should_flatten(object item):
+    """True if ITEM is an iterable that flatten_list() and flatten_into() should
+    descend into, rather than an atom to be passed through as-is.
+    """
+    if isinstance(item, _container_types):
+        return True
+    if isinstance(item, _atom_types):
+        return False
+    try:
+        return _is_iterable_type[type(item)]
+    except KeyError:
+        ret = _is_iterable_type[type(item)] = isinstance(item, Iterable)
+        return ret
 
 
 def flatten_list(l: Iterable) -> Generator[Any, None, None]:
@@ -35,27 +58,59 @@ def flatten_list(l: Iterable) -> Generator[Any, None, None]:
     time. Strings and string-like objects count as non-iterables for this function.
 
     No matter how deeply nested the iterables are, only non-iterable atomic elements
-    are yielded.
+    are yielded. Nested iterables are tracked on an explicit stack rather than by
+    recursion, so deep nesting can't run into Python's recursion limit.
     """
-    for item in l:
-        if isinstance(item, Iterable) and not isinstance(item, (str, bytes, bytearray)):
-            yield from item
-        else:
+    iterators = [iter(l)]
+    push = iterators.append
+    while iterators:
+        for item in iterators[-1]:
+            if _should_flatten(item):
+                push(iter(item))    # Finish flattening ITEM before going on with the rest of this level.
+                break
             yield item
+        else:
+            iterators.pop()
 
 
-def _default_path_formatter(path: bytearray,
-                            path_length: int,
-                            path_translation_dict: dict,
+def flatten_into(l: Iterable, out: Optional[list] = None) -> list:
+    """Eager version of flatten_list(), above: appends the atomic elements of L, in
+    the same order flatten_list() would yield them, to OUT, which is then returned.
+    If OUT is not supplied, a new list is created. Cheaper than list(flatten_list(L))
+    because no generator has to be suspended and resumed for every element.
+    """
+    if out is None:
+        out = list()
+    append = out.append
+    iterators = [iter(l)]
+    push = iterators.append
+    while iterators:
+        for item in iterators[-1]:
+            if _should_flatten(item):
+                push(iter(item))
+                break
+            append(item)
+        else:
+            iterators.pop()
+    return out
+
+
+def _default_path_formatter(const unsigned char[::1] path,
+                            Py_ssize_t path_length,
+                            tuple path_names,
                             start: Hashable, 
                             node_translation_dict: dict) -> str:
-    """Takes PATH, a bytearray, and uses PATH_TRANSLATION_DICT to turn it into a
-    human-readable form. Optionally, also uses START and NODE_TRANSLATION_DICT to
+    """Takes PATH, a bytearray, and uses PATH_NAMES to turn it into a human-readable
+    form. PATH_NAMES is a tuple of 256 items, the Nth of which is the name of the
+    path with ID N, or None if there is no path with that ID; formatting a path that
+    uses such an ID raises KeyError. Optionally, also uses START and NODE_TRANSLATION_DICT to
     indicate which node begins the path.
 
     Ignores any zero bytes at the end of the array; those are steps not taken. Zero
     bytes must occur in a contiguous block at the end of the array; no non-zero
-    bytes may follow them.
+    bytes may follow them. PATH is read through a typed memoryview, so any bytes-like
+    object will do, and the bytes are read as C integers rather than one Python int
+    at a time.
 
     If either of START or NODE_TRANSLATION_DICT is supplied, the other must also be
     supplied.
@@ -65,19 +120,89 @@ def _default_path_formatter(path: bytearray,
     """
     if start: assert node_translation_dict, f"ERROR! If START is specified, NODE_TRANSLATION_DICT must also be specified!"
     if node_translation_dict: assert start, f"ERROR! If NODE_TRANSLATION_DICT is specified, START must also be specified!"
-    
-    if 0 in path:
-        first_loc = path.find(0)
-        for i, byte in enumerate(path[first_loc:], first_loc):
-            assert byte == 0, f"Zero-bytes can only occur contiguously at the end of a path, not at the beginning or in the middle! The byte {byte} in position {i} in path {path}, however, breaks this rule!"
+    return _format_path(path, path_names, _path_prefix(start, node_translation_dict))
+
 
+cdef str _path_prefix(start, node_translation_dict):
+    """Returns the text that goes before every path that begins at START: the name of
+    the node, according to NODE_TRANSLATION_DICT, and a colon. If no START was given,
+    that's an empty string.
+    """
     if start:
-        ret = node_translation_dict[start] + ': '
-    else:
-        ret = ''
+        return node_translation_dict[start] + ': '
+    return ''
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef str _format_path(const unsigned char[::1] path,
+                      tuple path_names,
+                      str prefix):
+    """Does the actual work for _default_path_formatter(), above, without checking
+    its arguments; also called directly by _PathFormatter, below. PREFIX is the
+    already-worked-out text that goes in front of the path (see _path_prefix()).
+    """
+    cdef Py_ssize_t i, end = 0, length = path.shape[0]
 
-    ret += ' -> '.join(str(path_translation_dict[p]) for p in path if p)
-    return ret
+    while (end < length) and path[end]:     # Everything from the first zero byte on is steps not taken ...
+        end += 1
+    if __debug__:
+        for i in range(end, length):        # ... and had better all be zeroes.
+            assert path[i] == 0, f"Zero-bytes can only occur contiguously at the end of a path, not at the beginning or in the middle! The byte {path[i]} in position {i} in path {bytes(path)}, however, breaks this rule!"
+
+    try:
+        ret = ' -> '.join([path_names[path[i]] for i in range(end)])
+    except TypeError:               # A None in the list: a path ID with no name in the translation dict.
+        for i in range(end):
+            if path_names[path[i]] is None:
+                raise KeyError(f"ERROR! Path {bytes(path[:end])} uses path ID {path[i]}, which has no name in the path translation dictionary!") from None
+        raise
+    return (prefix + ret) if prefix else ret
+
+
+cdef class _PathFormatter:
+    """A callable version of _default_path_formatter(), above, with everything but
+    PATH and PATH_LENGTH already filled in; default_path_formatter(), below, creates
+    these. Calling one of these costs less than calling a functools.partial, which
+    has to merge its stored keyword arguments into every call, and, unlike a
+    closure, it can still be pickled and sent to worker processes.
+    """
+    cdef readonly tuple path_names
+    cdef readonly object start
+    cdef readonly object node_translation_dict
+    cdef str prefix
+
+    def __init__(self, tuple path_names, start, node_translation_dict):
+        self.path_names = path_names
+        self.start = start
+        self.node_translation_dict = node_translation_dict
+        self.prefix = _path_prefix(start, node_translation_dict)     # START is fixed, so its name is looked up just once.
+
+    def __reduce__(self):
+        return _PathFormatter, (self.path_names, self.start, self.node_translation_dict)
+
+    def __call__(self, path, path_length):
+        return _format_path(path, self.path_names, self.prefix)
+
+    def format_all(self, paths: Iterable) -> List[str]:
+        """Formats each of PATHS, a collection of bytes-like objects, returning a list
+        of the resulting strings. Does the same thing as calling this formatter on each
+        path in turn, but makes no Python-level call per path.
+        """
+        return [_format_path(p, self.path_names, self.prefix) for p in paths]
+
+
+def format_paths(formatter: Callable, paths: Iterable) -> List[str]:
+    """Uses FORMATTER, a path formatter of the kind returned by
+    default_path_formatter(), below, to format each of PATHS, a collection of
+    bytes-like objects, and returns a list of the resulting strings.
+
+    Formatters made by default_path_formatter() handle the whole batch at once.
+    Any other formatter is called once per path, with a bytearray copy of the path.
+    """
+    if isinstance(formatter, _PathFormatter):
+        return formatter.format_all(paths)
+    return [formatter(bytearray(p), len(p)) for p in paths]
 
 
 def default_path_formatter(path_translation_dict: Dict[int, Hashable], *,
@@ -87,17 +212,27 @@ def default_path_formatter(path_translation_dict: Dict[int, Hashable], *,
     _default_path_formatter() that can be called with just PATH and PATH_LENGTH.
     Useful for passing into functions in the main Königsberg code that expect to
     just take a function that can process a bytearray PATH and its length.
+
+    Path IDs are bytes, so the names of the paths are worked out once, here, into a
+    256-entry tuple that the formatter can index by ID, rather than being looked up
+    in PATH_TRANSLATION_DICT and converted to strings every time a path is printed.
+    IDs that PATH_TRANSLATION_DICT doesn't name get None in that tuple, so that
+    formatting a path that uses one raises KeyError instead of printing a blank.
     """
     assert all([start, node_translation_dict]) or all([not start, not node_translation_dict])
-    return functools.partial(_default_path_formatter, path_translation_dict=path_translation_dict,
-                             start=start, node_translation_dict=node_translation_dict)
+    path_names = tuple(str(path_translation_dict[i]) if (i in path_translation_dict) else None for i in range(256))
+    return _PathFormatter(path_names, start, node_translation_dict)
 
 
 def maximally_dense_network_graph(num_nodes: int) -> Dict[int, Iterable[int]]:
     """Automatically constructs and returns a graph with NUM_NODES nodes, each of
     which is connected to every other node.
+
+    Each node's list is the full list of nodes with the node itself sliced out,
+    rather than a filtered copy, so no per-element comparison is needed.
     """
-    return {n: [d for d in range(1, 1 + num_nodes) if d != n] for n in range(1, 1 + num_nodes)}
+    all_nodes = list(range(1, 1 + num_nodes))
+    return {n: all_nodes[:n-1] + all_nodes[n:] for n in all_nodes}
 
 
 def _sanity_check_graph(graph: Dict[Hashable, Iterable[Hashable]],
@@ -107,17 +242,27 @@ def _sanity_check_graph(graph: Dict[Hashable, Iterable[Hashable]],
     NODES_TO_PATHS. If RAISE_ERROR is True, failing a sanity check raises a
     ValueError (and execution terminates); if it is False, the function returns
     False instead of crashing.
+
+    When Python is run with -O, assertions are disabled, so the checks are
+    skipped entirely rather than looping over the graph to do nothing.
     """
+    if not __debug__:
+        return True, None
     try:
         assert isinstance(graph, dict), f"The supplied graph {graph} is not a dictionary representing a node-to-node graph!"
+        neighbors = dict()                                      # Same as GRAPH, but with sets, so checking for paths back is quick.
         for node, dest_list in graph.items():
             assert isinstance(node, Hashable), f"Node {node} in the supplied graph is not a hashable value, and cannot be used as a node label!"
             assert isinstance(dest_list, Iterable), f"The destination list for node {node} in the supplied graph is not a list-like object!"
             assert not isinstance(dest_list, (str, bytes, bytearray)), f"The destination list for node {node} is a string or string-like object of type {type(dest_list)}, and these cannot be used as destination lists for graphs!"
+            neighbors[node] = set()
             for dest in dest_list:
                 assert isinstance(dest, Hashable), f"The destination node {dest} given in the destination list for the node {node} in the supplied graph is not a hashable value, and cannot be used as the label for a node!"
+                neighbors[node].add(dest)
+        for node, dest_set in neighbors.items():
+            for dest in dest_set:
                 assert dest in graph, f"The node '{node}' in the supplied graph is marked as going to the node '{dest}', but that second node does not have any outbound paths listed!"
-                assert node in graph[dest], f"The node {node} in the supplied graph is marked as going to the node {dest}, but that second node is not marked as leading back to {node}! (All pathways between nodes must explicitly be bidirectional.)"
+                assert node in neighbors[dest], f"The node {node} in the supplied graph is marked as going to the node {dest}, but that second node is not marked as leading back to {node}! (All pathways between nodes must explicitly be bidirectional.)"
 
         #FIXME! More tests?
         return True, None
@@ -136,26 +281,33 @@ def _sanity_check_dicts(paths_to_nodes: Dict[Hashable, Iterable[Hashable]],
     NODES_TO_PATHS. If RAISE_ERROR is True, failing a sanity check raises a
     ValueError (and execution terminates); if it is False, the function returns
     False instead of crashing.
+
+    As with _sanity_check_graph(), nothing is checked when Python is run with -O.
     """
+    if not __debug__:
+        return True, None
     try:
         assert isinstance(paths_to_nodes, Dict), f"The PATHS_TO_NODES parameter passed to _sanity_check_dicts() must be a dictionary, but is instead an instance of {type(paths_to_nodes)}!"
         assert isinstance(nodes_to_paths, Dict), f"The NODES_TO_PATHS parameter passed to _sanity_check_dicts() must be a dictionary, but is instead an instance of {type(nodes_to_paths)}!"
         assert len(paths_to_nodes.keys()) <= 255, f"Königsberg can only handle maps with up to 255 paths, but the supplied data has {len(paths_to_nodes.keys())} paths!"
 
-        paths_not_in_nodes = set(paths_to_nodes.keys()) - set(flatten_list(nodes_to_paths.values()))
-        assert not paths_not_in_nodes, f"Dictionary mapping paths to nodes has paths {paths_not_in_nodes} not connected to any node!"
-        nodes_not_in_paths = set(nodes_to_paths.keys()) - set(flatten_list(paths_to_nodes.values()))
-        assert not nodes_not_in_paths, f"Dictionary mapping nodes to paths has nodes {nodes_not_in_paths} not connected to any path!"
-
+        connected_nodes, connected_paths = set(), set()         # everything mentioned in either dict's values
         for path, node_list in paths_to_nodes.items():
             assert isinstance(node_list, Iterable), f"The node list for path {path} in the dictionary mapping paths to nodes is not a list-like object, but instead is a {type(node_list)}!"
             assert len(node_list) == 2, f"Path {path} should connect exactly two nodes, but instead it connects {len(node_list)}!"
             for node in node_list:
                 assert node in nodes_to_paths, f"Node {node} appears in the node list for path {path}, but does not appear in the dictionary mapping nodes to paths!"
+            connected_nodes.update(node_list)
         for node, path_list in nodes_to_paths.items():
             assert isinstance(path_list, Iterable), f"The path list for node {node} in the dictionary mapping nodes to paths is not a list-like object, but instead is a {type(path_list)}!"
             for path in path_list:
                 assert path in paths_to_nodes, f"Path {path} appears in the path list for node {node}, but does not appear in the dictionary mapping paths to nodes!"
+            connected_paths.update(path_list)
+
+        paths_not_in_nodes = paths_to_nodes.keys() - connected_paths
+        assert not paths_not_in_nodes, f"Dictionary mapping paths to nodes has paths {paths_not_in_nodes} not connected to any node!"
+        nodes_not_in_paths = nodes_to_paths.keys() - connected_nodes
+        assert not nodes_not_in_paths, f"Dictionary mapping nodes to paths has nodes {nodes_not_in_paths} not connected to any path!"
 
         # FIXME! More checks?
         return True, None
@@ -169,6 +321,7 @@ def _sanity_check_dicts(paths_to_nodes: Dict[Hashable, Iterable[Hashable]],
 def normalize_dicts(paths_to_nodes: Dict[Hashable, Iterable[Hashable]],
                     nodes_to_paths: Dict[Hashable, Iterable[Hashable]],
                     raise_error: bool = True,
+                    sanity_checked: bool = False,
                     ) -> Tuple[Dict[int, Tuple[int]], Dict[int, Tuple[int]],
                                Dict[int, Hashable], Dict[int, Hashable],
                                Dict[Hashable, int], Dict[Hashable, int]]:
@@ -185,34 +338,39 @@ def normalize_dicts(paths_to_nodes: Dict[Hashable, Iterable[Hashable]],
      5. a dictionary mapping human-supplied path descriptions to path IDs;
      6. a dictionary mapping human-supplied node descriptions to node IDs.
 
-    Performs some basic sanity checks on the supplied data before doing all of this.
+    Performs some basic sanity checks on the supplied data before doing all of this,
+    unless SANITY_CHECKED is True, indicating that the caller has already run
+    _sanity_check_dicts() on the same data.
 
     #FIXME: optimization (later): return None for items 3 and/or 4 if the human-
     supplied descriptions were already integers.
     """
-    check, errrr = _sanity_check_dicts(paths_to_nodes, nodes_to_paths, raise_error)
-    if not check:
-        traceback.print_exception(type(errrr), errrr, errrr.__traceback__, chain=True)
-        sys.exit(3)
-
-    # First, set up the translation tables that we're going to return so that our int-based dictionaries can be decoded later for the user
-    paths_x = dict(zip(range(1, 256), sorted(paths_to_nodes.keys())))
-    nodes_x = dict(zip(range(1, 256), sorted(nodes_to_paths.keys())))
-
-    # And the opposite-direction translation tables so we can translate the user-supplied dicts in the first place.
-    paths_x_rev = {value: key for key, value in paths_x.items()}
-    nodes_x_rev = {value: key for key, value in nodes_x.items()}
-
-    paths_ret, nodes_ret = dict(), dict()
-    for path, node_list in paths_to_nodes.items():
-        paths_ret[paths_x_rev[path]] = tuple(sorted(nodes_x_rev[i] for i in node_list))
-    for node, path_list in nodes_to_paths.items():
-        nodes_ret[nodes_x_rev[node]] = tuple(sorted(paths_x_rev[i] for i in path_list))
+    if not sanity_checked:
+        check, errrr = _sanity_check_dicts(paths_to_nodes, nodes_to_paths, raise_error)
+        if not check:
+            traceback.print_exception(type(errrr), errrr, errrr.__traceback__, chain=True)
+            sys.exit(3)
+
+    # Set up the translation tables that we're going to return so that our int-based dictionaries can be decoded later
+    # for the user, plus the opposite-direction tables so we can translate the user-supplied dicts in the first place.
+    # IDs are assigned in sorted order so that the same map always gets the same IDs, which checkpoint files rely on.
+    paths_x, paths_x_rev = dict(), dict()
+    for i, path in enumerate(sorted(paths_to_nodes.keys()), 1):
+        paths_x[i], paths_x_rev[path] = path, i
+    nodes_x, nodes_x_rev = dict(), dict()
+    for i, node in enumerate(sorted(nodes_to_paths.keys()), 1):
+        nodes_x[i], nodes_x_rev[node] = node, i
+
+    # The order of the two ends of a path doesn't matter. The order of the paths leaving a node is the order in which
+    # they're explored, so those are sorted, to keep the order in which solutions are found predictable.
+    paths_ret = {paths_x_rev[path]: tuple(nodes_x_rev[i] for i in node_list) for path, node_list in paths_to_nodes.items()}
+    nodes_ret = {nodes_x_rev[node]: tuple(sorted(paths_x_rev[i] for i in path_list)) for node, path_list in nodes_to_paths.items()}
 
     return (paths_ret, nodes_ret, paths_x, nodes_x, paths_x_rev, nodes_x_rev)
 
 
-def graph_to_dicts(graph: Dict[Hashable, Iterable[Hashable]]
+def graph_to_dicts(graph: Dict[Hashable, Iterable[Hashable]],
+                   sanity_checked: bool = False,
                    ) -> Tuple[Dict[Hashable, Iterable[Hashable]], Dict[Hashable, Iterable[Hashable]]]:
     """Turns the graph GRAPH into a pair of dictionaries, the first of which maps
     paths to nodes, the second of which maps nodes to paths. A "graph" is a
@@ -231,22 +389,27 @@ def graph_to_dicts(graph: Dict[Hashable, Iterable[Hashable]]
       2. That if A -> B is represented in the graph, then B -> A must also be
          represented in the graph -- this is a guard intended to help detect data
          entry errors.
+    These checks are skipped if SANITY_CHECKED is True, indicating that the caller
+    has already run _sanity_check_graph() on GRAPH.
 
     You will presumably want to call normalize_dicts() on this pair, or at least
     _sanity_check_dicts(), but this function does not do so for you.
     """
-    check, errrr = _sanity_check_graph(graph)
-    if not check:
-        traceback.print_exception(type(errrr), errrr, errrr.__traceback__, chain=True)
-        sys.exit(3)
+    if not sanity_checked:
+        check, errrr = _sanity_check_graph(graph)
+        if not check:
+            traceback.print_exception(type(errrr), errrr, errrr.__traceback__, chain=True)
+            sys.exit(3)
 
-    all_paths = set()
+    paths_to_nodes, nodes_to_paths = dict(), dict()
     for node, dest_list in graph.items():
+        node_paths = list()
         for dest in dest_list:
-            all_paths.add(tuple(sorted([dest, node])))
-
-    nodes_to_paths = {key: tuple(sorted([tuple(sorted([key, v])) for v in value])) for key, value in graph.items()}
-    paths_to_nodes = {path: (path[0], path[1]) for path in sorted(all_paths)}
+            path = (node, dest) if (node <= dest) else (dest, node)
+            paths_to_nodes[path] = path
+            node_paths.append(path)
+        nodes_to_paths[node] = tuple(sorted(node_paths))
+    paths_to_nodes = dict(sorted(paths_to_nodes.items()))
 
     return (paths_to_nodes, nodes_to_paths)
 
@@ -1,3 +1,4 @@
+# cython: language_level=3
 """Utility code for the map_wizard utility for Koenigsberg.
 
 This program was written by Patrick Mooney. It is copyright 2022. It is
@@ -7,13 +8,18 @@ version. See the file LICENSE.md for details.
 
 
 import collections
+import functools
 import json
+import re
 import shutil
 import sys
 import textwrap
 
 from pathlib import Path
-from typing import Dict, Iterable, Mapping
+from typing import Dict, Iterable, Mapping, Tuple
+
+
+connection_separator = re.compile(r'\s*;\s*')     # semicolon between node names in get_graph(), and any spaces around it
 
 
 def terminal_width(default: int = 80) -> None:
@@ -29,27 +35,45 @@ def terminal_width(default: int = 80) -> None:
     return width
 
 
+@functools.lru_cache(maxsize=32)
+def _get_wrapper(width: int) -> textwrap.TextWrapper:
+    """Return a TextWrapper that wraps text to WIDTH columns the way that
+    _get_wrapped_lines() wants it wrapped. Only one is ever created for each WIDTH.
+    """
+    return textwrap.TextWrapper(width=width, replace_whitespace=False, expand_tabs=False)
+
+
+@functools.lru_cache(maxsize=64)
+def _wrap_paragraph(paragraph: str,
+                    width: int) -> Tuple[str, ...]:
+    """Wrap PARAGRAPH to WIDTH columns, remembering the result, so that a paragraph
+    that's displayed again at the same width (say, because the user asked to see
+    the same menu or explanation again) doesn't need to be wrapped again.
+    """
+    return tuple(_get_wrapper(width).wrap(paragraph))
+
+
 def _get_wrapped_lines(paragraph: str,
                        indent_width: int = 0,
                        enclosing_width = -1) -> None:
-    """Function that splits the paragraph into lines. Mostly just wraps textwrap.wrap().
+    """Function that splits the paragraph into lines. Mostly just wraps TextWrapper.wrap().
 
     Note: Strips leading and trailing spaces.
     """
     if enclosing_width == -1:
         enclosing_width = terminal_width()
-    ret = textwrap.wrap(paragraph, width=enclosing_width - 2*indent_width, replace_whitespace=False, expand_tabs=False, drop_whitespace=False)
-    return [ l.rstrip() for l in ret ]
+    return list(_wrap_paragraph(paragraph, enclosing_width - 2*indent_width))
 
 
 def print_wrapped_lines(paragraph: str,
                         indent_width: int = 0,
                         enclosing_width = -1) -> None:
     """Convenience wrapper that prints the result of _get_wrapped_lines() to
-    stdout.
+    stdout, all in one write.
     """
-    for l in _get_wrapped_lines(paragraph, indent_width, enclosing_width):
-        print(l)
+    lines = _get_wrapped_lines(paragraph, indent_width, enclosing_width)
+    if lines:
+        print('\n'.join(lines))
 
 
 def menu_choice(choice_menu: Mapping,
@@ -84,28 +108,33 @@ def menu_choice(choice_menu: Mapping,
     spacing_column_width = 3
     options_column_width = terminal_width() - (menu_column_width + spacing_column_width + 1)
 
-    # OK, let's print this menu.
-    print()
+    # None of this depends on which option is being printed, so work it out once.
+    label_width = len('[  ]') + max_menu_item_width + spacing_column_width     # option label, then padding up to its text
+    separator_line = '  --  '.ljust(label_width) + '-----'
+    left_padding = '\n' + (' ' * (menu_column_width + spacing_column_width))
+
+    # OK, let's print this menu, all at once, noting which options can be chosen as we go.
+    menu_lines, legal_options = list(), list()
     for option, text in choice_menu.items():
         if (option == '--') and (text == '--'):
-            current_line = '  --  ' + ' ' * (max_menu_item_width - len('--')) + ' ' * spacing_column_width + '-----'
+            current_line = separator_line
         else:
-            current_line = '[ %s ]%s%s' % (option, ' ' * (max_menu_item_width - len(option)), ' ' * spacing_column_width)
+            legal_options.append(option.lower())
+            current_line = f'[ {option} ]'.ljust(label_width)
             text_lines = _get_wrapped_lines(text, enclosing_width=options_column_width)
             if len(text_lines) == 1:
                 current_line = current_line + text_lines[0]
             else:
                 current_line = current_line + text_lines.pop(0)     # Finish the line with the first line of the description
-                left_padding = '\n' + (' ' * (menu_column_width + spacing_column_width))
                 current_line = current_line + left_padding + left_padding.join(text_lines)     # Add in the rest of the lines
-        print(current_line)
-    print()
+        menu_lines.append(current_line)
+    print('\n' + '\n'.join(menu_lines) + '\n')
 
     # Now, get the user's choice
     choice = 'not a legal option'
-    legal_options = [ k.lower() for k, v in choice_menu.items() if ((k != '--') or (v != '--')) ]
+    choosable = frozenset(legal_options)        # LEGAL_OPTIONS keeps menu order for the prompt; this is for lookups
     tried_yet = False
-    while choice.lower() not in legal_options:
+    while choice.lower() not in choosable:
         if tried_yet:           # If the user has got it wrong at least once...
             prompt = prompt.strip() + " [ %s ] " % ('/'.join(legal_options))
         choice = input(prompt.strip() + " ").strip()
@@ -168,8 +197,8 @@ def get_graph() -> Dict[str, Iterable[str]]:
         while not connections_entered:
             print("Enter the names of other nodes that this node is connected to, separated by semicolons:")
             connections = input("  ")
-            if not connections: continue
-            cons_list = sorted(set([i.strip() for i in connections.split(';')]))
+            cons_list = sorted({c for c in connection_separator.split(connections.strip()) if c})
+            if not cons_list: continue
             connections_entered = True
 
         ret[node_name].extend(cons_list)
@@ -177,16 +206,45 @@ def get_graph() -> Dict[str, Iterable[str]]:
             done = True
             print('\n\n')
 
-    # now make sure that every x -> y connection has a corresponding y -> x connection
-    massaged = collections.defaultdict(list)
-    for node in ret:
-        for conn in ret[node]:
-            if conn not in massaged[node]:
-                massaged[node].append(conn)
-            if node not in massaged[conn]:
-                massaged[conn].append(node)
+    return _make_connections_reciprocal(ret)
 
-    return dict(massaged)
+
+def get_graph_all_at_once() -> Dict[str, Iterable[str]]:
+    """Read a whole graph-type map from the user in one go, one node per line, in the
+    form "node: other node; another node; ...", stopping at the first blank line or
+    at the end of input. This is quicker than get_graph() when the graph has already
+    been written out somewhere and can just be pasted in, or when input is coming
+    from a file or a pipe rather than from a person.
+    """
+    print_wrapped_lines("Enter (or paste in) the whole graph, one node per line, with each line in the form  node: other node; another node; ...  "
+                        "and end with a blank line.")
+    ret = collections.defaultdict(list)
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            break
+        node_name, colon, connections = line.partition(':')
+        node_name = node_name.strip()
+        cons_list = sorted({c for c in connection_separator.split(connections.strip()) if c})
+        if (not colon) or (not node_name) or (not cons_list):
+            print(f"ERROR! Cannot understand the line {line.strip()!r}, which has been ignored!")
+            continue
+        ret[node_name].extend(cons_list)
+    print('\n\n')
+
+    return _make_connections_reciprocal(ret)
+
+
+def _make_connections_reciprocal(graph: Mapping[str, Iterable[str]]) -> Dict[str, Iterable[str]]:
+    """Return a copy of GRAPH in which every x -> y connection has a corresponding
+    y -> x connection, with no connection listed twice.
+    """
+    massaged = collections.defaultdict(dict)        # dicts, not sets, so connections stay in the order they were first seen
+    for node in graph:
+        for conn in graph[node]:
+            massaged[node][conn] = None
+            massaged[conn][node] = None
+
+    return {node: list(conns) for node, conns in massaged.items()}
 
 
 def do_choose_for_me() -> str:
@@ -211,20 +269,21 @@ def do_print_explanation() -> None:
     """Print some explanatory text about the types of files this program can create,
     then return.
     """
+    width = terminal_width()
     print_wrapped_lines("This wizard can create either of two types of data files used by Koenigsberg: .graph files or .map files. .graph files are "
     "simpler and faster to create: they consist of nodes information about which nodes each node connects to. They do not allow for the paths between "
     " nodes to have names, nor do they allow for a pair of nodes to be connected by more than a single path. This type of structured data is appropriate "
     "for many, but not all, of the problems that Koenisberg can solve. Data in this format is relatively quick to enter from a keyboard because "
-    "Koenigsberg can infer some of the needed information about the topological structure of the graph.")
+    "Koenigsberg can infer some of the needed information about the topological structure of the graph.", enclosing_width=width)
     print()
     print_wrapped_lines(".map files, like .graph files, consist of nodes connected to each other by pathways, but there can be multiple pathways connecting "
     "each pair of nodes, and the pathways between nodes can have names. This data can take longer to enter at a keyboard, because Koenigsberg makes no attempt "
-    "to infer information about the topological structure of the graph being described.")
+    "to infer information about the topological structure of the graph being described.", enclosing_width=width)
     print()
     print_wrapped_lines("In either case, you will almost certainly find it helpful to sketch out the structure of your map in advance, and to have the sketch "
-    "sitting in front of you while you input its structure into this program.")
+    "sitting in front of you while you input its structure into this program.", enclosing_width=width)
     print()
-    print_wrapped_lines("It is also possible to hand-write either .graph or .map files if that is easier for you to do; see the manual for more information.")
+    print_wrapped_lines("It is also possible to hand-write either .graph or .map files if that is easier for you to do; see the manual for more information.", enclosing_width=width)
     print('\n')
 
 
@@ -238,13 +297,20 @@ def get_save_file_name(default_ext: str,
         default_ext = '.' + default_ext.strip()
     filename = None
 
+    try:                                    # Use TKinter if possible
+        import tkinter
+        import tkinter.filedialog
+        tkinter.Tk().withdraw()             # No root window. Set up just once, however many times we have to ask.
+    except BaseException:
+        tkinter = None
+
     while not filename:
-        try:                                # Use TKinter if possible
-            import tkinter
-            import tkinter.filedialog
-            tkinter.Tk().withdraw()         # No root window
-            filename = tkinter.filedialog.asksaveasfilename(title=f"Save {file_type_name} as ...", defaultextension=default_ext)
-        except BaseException:                             # If all else fails, ask the user to type it.
+        if tkinter is not None:
+            try:
+                filename = tkinter.filedialog.asksaveasfilename(title=f"Save {file_type_name} as ...", defaultextension=default_ext)
+            except BaseException:
+                tkinter = None              # Don't try the dialog again if it failed once.
+        if tkinter is None:                 # If all else fails, ask the user to type it.
             filename = input('Under what name would you like to save the file? ').strip()
 
         if not filename:
@@ -267,6 +333,7 @@ def do_make_map() -> None:
     choices = {
         'm': '.map file',
         'g': '.graph file',
+        'b': '.graph file, typed or pasted in all at once rather than one node at a time',
         '--': '--',
         '?': 'provide an explanation of differences, then ask again',
         'p': 'have the program decide for you after asking a series of questions',
@@ -282,6 +349,8 @@ def do_make_map() -> None:
 
     if choice == 'm':
         default_ext, file_type_name, the_data = '.map', 'map file', get_map()
+    elif choice == 'b':
+        default_ext, file_type_name, the_data = '.graph', 'graph file', get_graph_all_at_once()
     else:
         default_ext, file_type_name, the_data = '.graph', 'graph file', get_graph()
 